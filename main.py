@@ -1,16 +1,25 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import Response
 import pandas as pd
 from typing import Literal
 import numpy as np
+import orjson
+import pyarrow.parquet as pq
 from openpyxl import load_workbook
 from openpyxl.utils.dataframe import dataframe_to_rows
 from openpyxl.utils import get_column_letter, range_boundaries
+import io
+import json
 import os
-import requests
+import re
+import tempfile
+import threading
+import asyncio
+import httpx
 from msal import ConfidentialClientApplication
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -28,6 +37,7 @@ app.add_middleware(
 TENANT_ID = os.getenv("TENANT_ID")
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
+GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
 
 archivos_config = [
     {
@@ -43,32 +53,118 @@ archivos_config = [
 download_dir = "./descargas"
 os.makedirs(download_dir, exist_ok=True)
 
+ruta_traduccion = os.path.join(download_dir, "Traduccion-Equipos.xlsx")
+ruta_compras = os.path.join(download_dir, "002_Compras_OCI.xlsx")
+ruta_consolidado = os.path.join(download_dir, "consolidado.parquet")
+# Sufijo de las columnas auxiliares con la parte numérica de columnas mezcladas
+SUFIJO_NUMERO = "__numero"
+
+COLUMNAS_TRADUCCION = [
+    'Codigo_Comercial', 'Item', 'Codigo', 'Modelo', 'Descripcion',
+    'Material', 'Uso', 'Marca'
+]
+
+COLUMNAS_COMPRAS = [
+    'Codigo_Comercial', 'Cantidad', 'Num_OC', 'Num_invoice', 'PaisOrigen',
+    'Moneda', 'PCU1', 'Flete_US$', 'OperadorLogistico', 'Fecha_Invoice',
+    'GrupoImportacion', 'Num_DocTransporte', 'RazonSocial_Proveedor',
+    'Incoterm', 'Forma_Pago', 'Status_OCI'
+]
+
+COLUMNAS_RENOMBRADAS = {
+    'Cantidad': 'Cant',
+    'Num_OC': 'Nº O.COMPRA',
+    'Num_invoice': 'FACTURA',
+    'PaisOrigen': 'País De Origen',
+    'PCU1': 'Precio Unitario',
+    'Flete_US$': 'Flete',
+    'OperadorLogistico': 'TRANSPORTISTA',
+    'Fecha_Invoice': 'FECHA FACTURA',
+    'GrupoImportacion': 'Nº EMBARQUE',
+    'Num_DocTransporte': 'Air Waybill',
+    'RazonSocial_Proveedor': 'PROVEEDOR',
+    'Incoterm': 'INCOTERM',
+    'Forma_Pago': 'FORMA DE PAGO',
+    'Status_OCI': 'ESTADO'
+}
+
+COLUMNAS_NUMERICAS = ['Cant', 'Precio Unitario', 'Flete']
+
+COLUMNAS_DATOS = [
+    'Item', 'Cant', 'Nº O.COMPRA', 'FACTURA', 'Codigo', 'Modelo', 'Descripcion',
+    'Material', 'Uso', 'País De Origen', 'Moneda', 'Precio Unitario', 'Sub Total',
+    'Flete', 'Precio Total', 'TRANSPORTISTA', 'FECHA FACTURA',
+    'Nº EMBARQUE', 'Air Waybill', 'PROVEEDOR',
+    'INCOTERM', 'FORMA DE PAGO', 'ESTADO', 'Marca'
+]
+
+COLUMNAS_EXPORTAR = [
+    'Item', 'Cant', 'Nº O.COMPRA', 'FACTURA', 'Codigo', 'Modelo', 'Descripcion',
+    'Material', 'Uso', 'País De Origen', 'Moneda', 'Precio Unitario', 'Sub Total',
+    'Flete', 'Precio Total'
+]
+
 archivos_inicializados = False
 
+# Cliente HTTP/2 compartido para reutilizar las conexiones con Graph entre sincronizaciones
+_http_client = None
+
+# Pool compartido para leer los dos libros de Excel en paralelo al consolidar
+lector_executor = ThreadPoolExecutor(max_workers=2)
+
+# Evita que /sync y las consultas regeneren el consolidado a la vez
+consolidado_lock = threading.Lock()
+
+# Instancia única de MSAL para reutilizar su caché de tokens entre sincronizaciones
+_msal_app = None
+
+
+def obtener_http_client():
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=60,
+            # downloadUrl puede responder con una redirección, igual que hacía requests
+            follow_redirects=True,
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=3,
+                limits=httpx.Limits(max_connections=8, max_keepalive_connections=8)
+            )
+        )
+    return _http_client
+
+
+def obtener_msal_app():
+    global _msal_app
+    if _msal_app is None:
+        _msal_app = ConfidentialClientApplication(
+            CLIENT_ID,
+            authority=f"https://login.microsoftonline.com/{TENANT_ID}",
+            client_credential=CLIENT_SECRET
+        )
+    return _msal_app
+
 
 def obtener_token():
-    msal_app = ConfidentialClientApplication(
-        CLIENT_ID,
-        authority=f"https://login.microsoftonline.com/{TENANT_ID}",
-        client_credential=CLIENT_SECRET
-    )
-    result = msal_app.acquire_token_for_client(
-        scopes=["https://graph.microsoft.com/.default"]
-    )
+    msal_app = obtener_msal_app()
+    result = msal_app.acquire_token_silent(scopes=GRAPH_SCOPES, account=None)
+    if not result:
+        result = msal_app.acquire_token_for_client(scopes=GRAPH_SCOPES)
     return result["access_token"]
 
 
-def obtener_drive_id(token):
+async def obtener_drive_id(token, client):
     headers = {'Authorization': f'Bearer {token}'}
     site_url = "https://graph.microsoft.com/v1.0/sites/corsusaadmin.sharepoint.com:/sites/logistica"
-    site_response = requests.get(site_url, headers=headers)
+    site_response = await client.get(site_url, headers=headers)
 
     if site_response.status_code != 200:
         raise Exception(f"Error al obtener sitio: {site_response.status_code}")
 
     site_id = site_response.json()['id']
     drives_url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives"
-    drives_response = requests.get(drives_url, headers=headers)
+    drives_response = await client.get(drives_url, headers=headers)
     drives = drives_response.json()['value']
 
     document_drive = None
@@ -83,67 +179,112 @@ def obtener_drive_id(token):
     return document_drive['id']
 
 
-def descargar_archivo(config, drive_id, headers, download_dir):
+async def descargar_archivo(config, drive_id, headers, download_dir, client):
     try:
         unique_id = config['unique_id']
         nombre = config['nombre']
         file_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{unique_id}"
-        file_response = requests.get(file_url, headers=headers)
+        file_response = await client.get(file_url, headers=headers)
 
         if file_response.status_code != 200:
-            return None, f"Error al obtener info del archivo {nombre}: {file_response.status_code}"
+            return None, f"Error al obtener info del archivo {nombre}: {file_response.status_code}", False
 
         file_data = file_response.json()
         download_url = file_data.get('@microsoft.graph.downloadUrl')
 
         if not download_url:
-            return None, f"No se pudo obtener URL de descarga para {nombre}"
+            return None, f"No se pudo obtener URL de descarga para {nombre}", False
 
-        file_content = requests.get(download_url)
+        ruta_archivo = os.path.join(download_dir, nombre)
+        ruta_metadatos = ruta_archivo + ".meta.json"
+        etag_anterior = None
+        if os.path.exists(ruta_archivo):
+            etag_anterior = leer_metadatos(ruta_metadatos).get('eTag')
+
+        metadatos = {
+            'eTag': file_data.get('eTag'),
+            'lastModifiedDateTime': file_data.get('lastModifiedDateTime')
+        }
+        if etag_anterior and etag_anterior == metadatos['eTag']:
+            return ruta_archivo, None, False
 
-        if file_content.status_code != 200:
-            return None, f"Error al descargar {nombre}: {file_content.status_code}"
+        download_headers = {'If-None-Match': etag_anterior} if etag_anterior else {}
+        async with client.stream('GET', download_url, headers=download_headers) as file_content:
+            if file_content.status_code == 304:
+                guardar_metadatos(ruta_metadatos, metadatos)
+                return ruta_archivo, None, False
 
-        ruta_archivo = os.path.join(download_dir, nombre)
-        with open(ruta_archivo, 'wb') as f:
-            f.write(file_content.content)
+            if file_content.status_code != 200:
+                return None, f"Error al descargar {nombre}: {file_content.status_code}", False
 
-        return ruta_archivo, None
+            with open(ruta_archivo, 'wb') as f:
+                async for chunk in file_content.aiter_bytes(chunk_size=1024 * 1024):
+                    f.write(chunk)
+
+        guardar_metadatos(ruta_metadatos, metadatos)
+        return ruta_archivo, None, True
 
     except Exception as e:
-        return None, f"Error descargando {config['nombre']}: {str(e)}"
+        return None, f"Error descargando {config['nombre']}: {str(e)}", False
 
 
-def sincronizar_archivos():
+def leer_metadatos(ruta_metadatos):
     try:
-        token = obtener_token()
+        with open(ruta_metadatos, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def guardar_metadatos(ruta_metadatos, metadatos):
+    with open(ruta_metadatos, 'w', encoding='utf-8') as f:
+        json.dump(metadatos, f)
+
+
+async def sincronizar_archivos():
+    try:
+        # MSAL es síncrono; se ejecuta en un hilo para no bloquear el event loop
+        token = await asyncio.to_thread(obtener_token)
         headers = {'Authorization': f'Bearer {token}'}
-        drive_id = obtener_drive_id(token)
+        client = obtener_http_client()
+        drive_id = await obtener_drive_id(token, client)
 
         archivos_descargados = []
+        archivos_actualizados = []
         errores = []
 
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = {
-                executor.submit(descargar_archivo, config, drive_id, headers, download_dir): config
-                for config in archivos_config
-            }
+        resultados = await asyncio.gather(
+            *(descargar_archivo(config, drive_id, headers, download_dir, client)
+              for config in archivos_config),
+            return_exceptions=True
+        )
 
-            for future in as_completed(futures):
-                config = futures[future]
-                try:
-                    ruta, error = future.result()
-                    if error:
-                        errores.append(error)
-                    else:
-                        archivos_descargados.append(ruta)
-                except Exception as e:
-                    errores.append(
-                        f"Excepción al procesar {config['nombre']}: {str(e)}")
+        for config, resultado in zip(archivos_config, resultados):
+            if isinstance(resultado, Exception):
+                errores.append(
+                    f"Excepción al procesar {config['nombre']}: {str(resultado)}")
+                continue
+            ruta, error, cambiado = resultado
+            if error:
+                errores.append(error)
+            else:
+                archivos_descargados.append(ruta)
+                if cambiado:
+                    archivos_actualizados.append(ruta)
+
+        # Se regenera si algún Excel es más reciente que el consolidado; así un fallo
+        # al consolidar se reintenta en la siguiente sincronización aunque el eTag no cambie
+        if archivos_descargados:
+            try:
+                if await asyncio.to_thread(asegurar_consolidado):
+                    cargar_tablas.cache_clear()
+            except Exception as e:
+                errores.append(f"Error al consolidar los archivos: {str(e)}")
 
         return {
             "exitoso": len(errores) == 0,
             "archivos_descargados": len(archivos_descargados),
+            "archivos_actualizados": len(archivos_actualizados),
             "total_archivos": len(archivos_config),
             "errores": errores
         }
@@ -152,16 +293,153 @@ def sincronizar_archivos():
         return {
             "exitoso": False,
             "archivos_descargados": 0,
+            "archivos_actualizados": 0,
             "total_archivos": len(archivos_config),
             "errores": [str(e)]
         }
 
 
+def asegurar_consolidado():
+    # Se vuelve a comprobar dentro del lock por si otro hilo ya lo regeneró
+    with consolidado_lock:
+        if not consolidado_desactualizado():
+            return False
+        _generar_consolidado()
+        return True
+
+
+def _generar_consolidado():
+    futuro_a = lector_executor.submit(
+        pd.read_excel, ruta_traduccion, sheet_name='Datos', skiprows=4, engine='calamine')
+    futuro_c = lector_executor.submit(
+        pd.read_excel, ruta_compras, skiprows=2, engine='calamine')
+    a = futuro_a.result()
+    c = futuro_c.result()
+    a = a.iloc[:, 1:]
+    # Sin Modelo o Codigo no hay clave válida; además el merge uniría claves vacías entre sí
+    b = a.dropna(subset=['Modelo', 'Codigo']).drop_duplicates(subset=['Modelo'], keep='first').assign(
+        Codigo_Comercial=lambda d: d['Modelo'])
+    # Solo se conservan las columnas que usan /data y /export, ya con sus nombres finales
+    b = b[COLUMNAS_TRADUCCION]
+    c = c[COLUMNAS_COMPRAS].rename(columns=COLUMNAS_RENOMBRADAS)
+    df = pd.merge(c, b, how='left', on='Codigo_Comercial', validate='m:1')
+    df = df.drop(columns=['Codigo_Comercial'])
+    for col in COLUMNAS_NUMERICAS:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    # Parquet no admite columnas con tipos mezclados (p. ej. facturas numéricas y de texto):
+    # los números se guardan en una columna auxiliar y se recombinan al cargar
+    for col in list(df.columns):
+        if df[col].dtype != object or df[col].dropna().map(type).nunique() <= 1:
+            continue
+        es_numero = df[col].map(lambda v: isinstance(v, (int, float)) and not isinstance(v, bool))
+        es_texto = df[col].map(lambda v: isinstance(v, str))
+        if not (es_numero | es_texto | df[col].isna()).all():
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+            continue
+        numeros = pd.to_numeric(df[col].where(es_numero))
+        if numeros.dropna().mod(1).eq(0).all():
+            numeros = numeros.astype('Int64')
+        df[col + SUFIJO_NUMERO] = numeros
+        df[col] = df[col].where(es_texto)
+
+    # Se escribe en un archivo temporal propio para no exponer un parquet a medio escribir
+    fd, ruta_temporal = tempfile.mkstemp(dir=download_dir, suffix='.parquet.tmp')
+    os.close(fd)
+    try:
+        df.to_parquet(ruta_temporal, engine='pyarrow', compression='zstd', index=False)
+        os.replace(ruta_temporal, ruta_consolidado)
+    except BaseException:
+        os.remove(ruta_temporal)
+        raise
+
+
+@lru_cache(maxsize=1)
+def cargar_tablas(mtime_consolidado):
+    df = pq.read_table(ruta_consolidado).to_pandas(integer_object_nulls=True)
+    for col_numero in [col for col in df.columns if col.endswith(SUFIJO_NUMERO)]:
+        col = col_numero[:-len(SUFIJO_NUMERO)]
+        numeros = df[col_numero].astype(object)
+        numeros = numeros.where(numeros.notna(), None)
+        df[col] = df[col].astype(object).where(df[col].notna(), numeros)
+        df = df.drop(columns=[col_numero])
+    # Columnas de búsqueda ya normalizadas, alineadas por posición con las filas de df
+    busqueda = {
+        'embarque': normalizar_busqueda(df['Nº EMBARQUE']),
+        'waybill': normalizar_busqueda(df['Air Waybill']),
+    }
+    return df, busqueda
+
+
+def normalizar_busqueda(serie):
+    return serie.astype(str).str.lower().fillna('').to_numpy(dtype=str)
+
+
+def coincidencias(busqueda, type, value):
+    return np.char.find(busqueda[type], value.lower()) >= 0
+
+
+def columna_numerica(serie):
+    # Solo se convierte con to_numeric si la columna no es ya de punto flotante
+    if serie.dtype.kind != 'f':
+        serie = pd.to_numeric(serie, errors='coerce')
+    valores = serie.to_numpy(dtype=np.float64, na_value=np.nan)
+    return np.where(np.isnan(valores), 0.0, valores)
+
+
+def reemplazar_nulos(df):
+    # Convierte NaN/inf en None solo en las columnas que los contienen
+    for col in df.columns:
+        serie = df[col]
+        if serie.dtype.kind == 'f':
+            validos = np.isfinite(serie.to_numpy())
+        else:
+            validos = serie.notna().to_numpy()
+        if not validos.all():
+            df[col] = serie.astype(object).where(validos, None)
+    return df
+
+
+def serializar_json(obj):
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    return str(obj)
+
+
+def respuesta_json(contenido):
+    # orjson serializa los registros y los escalares de numpy sin pasar por jsonable_encoder
+    return Response(
+        content=orjson.dumps(
+            contenido,
+            default=serializar_json,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        ),
+        media_type="application/json"
+    )
+
+
+def consolidado_desactualizado():
+    if not os.path.exists(ruta_consolidado):
+        return True
+    mtime_consolidado = os.path.getmtime(ruta_consolidado)
+    return any(
+        os.path.getmtime(ruta) > mtime_consolidado
+        for ruta in (ruta_traduccion, ruta_compras)
+        if os.path.exists(ruta)
+    )
+
+
+def obtener_tablas():
+    if consolidado_desactualizado():
+        asegurar_consolidado()
+    # La caché guarda solo la versión vigente del consolidado, indexada por su fecha de modificación
+    return cargar_tablas(os.path.getmtime(ruta_consolidado))
+
+
 @app.on_event("startup")
 async def startup_event():
     global archivos_inicializados
     print("Iniciando descarga inicial de archivos...")
-    resultado = sincronizar_archivos()
+    resultado = await sincronizar_archivos()
     if resultado["exitoso"]:
         archivos_inicializados = True
         print(
@@ -170,6 +448,12 @@ async def startup_event():
         print(f"❌ Error en inicialización: {resultado['errores']}")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    if _http_client is not None:
+        await _http_client.aclose()
+
+
 @app.get("/")
 def read_root():
     return {
@@ -179,9 +463,9 @@ def read_root():
 
 
 @app.post("/sync")
-def sincronizar():
+async def sincronizar():
     global archivos_inicializados
-    resultado = sincronizar_archivos()
+    resultado = await sincronizar_archivos()
     if resultado["exitoso"]:
         archivos_inicializados = True
     return resultado
@@ -196,61 +480,25 @@ def obtener_datos(type: Literal["embarque", "waybill"], value: str):
         )
 
     try:
-        ruta_traduccion = os.path.join(download_dir, "Traduccion-Equipos.xlsx")
-        ruta_compras = os.path.join(download_dir, "002_Compras_OCI.xlsx")
-
-        a = pd.read_excel(ruta_traduccion, sheet_name='Datos', skiprows=4)
-        a = a.iloc[:, 1:]
-        a['ID'] = a['Modelo'].astype(str) + '-' + a['Codigo'].astype(str)
-        b = a[~a['ID'].duplicated()]
-        b = b[~b['Modelo'].duplicated()]
-        b['Codigo_Comercial'] = b['Modelo']
-        c = pd.read_excel(ruta_compras, skiprows=2)
-        df = pd.merge(c, b, how='left', on='Codigo_Comercial')
-        df['PCU1'] = pd.to_numeric(df['PCU1'], errors='coerce').fillna(0)
-        df['Cantidad'] = pd.to_numeric(
-            df['Cantidad'], errors='coerce').fillna(0)
-        df['Flete_US$'] = pd.to_numeric(
-            df['Flete_US$'], errors='coerce').fillna(0)
-        df['Sub Total'] = df['PCU1'] * df['Cantidad']
-        df['Precio Total'] = df['Sub Total'] + df['Flete_US$']
-        df = df[[
-            'Item', 'Cantidad', 'Num_OC', 'Num_invoice', 'Codigo', 'Modelo', 'Descripcion',
-            'Material', 'Uso', 'PaisOrigen', 'Moneda', 'PCU1', 'Sub Total',
-            'Flete_US$', 'Precio Total', 'OperadorLogistico', 'Fecha_Invoice',
-            'GrupoImportacion', 'Num_DocTransporte', 'RazonSocial_Proveedor',
-            'Incoterm', 'Forma_Pago', 'Status_OCI', 'Marca'
-        ]]
-        new_columns = {
-            'Cantidad': 'Cant',
-            'Num_OC': 'Nº O.COMPRA',
-            'Num_invoice': 'FACTURA',
-            'PaisOrigen': 'País De Origen',
-            'PCU1': 'Precio Unitario',
-            'Flete_US$': 'Flete',
-            'OperadorLogistico': 'TRANSPORTISTA',
-            'Fecha_Invoice': 'FECHA FACTURA',
-            'GrupoImportacion': 'Nº EMBARQUE',
-            'Num_DocTransporte': 'Air Waybill',
-            'RazonSocial_Proveedor': 'PROVEEDOR',
-            'Incoterm': 'INCOTERM',
-            'Forma_Pago': 'FORMA DE PAGO',
-            'Status_OCI': 'ESTADO'
-        }
-        df.rename(columns=new_columns, inplace=True)
-        if type == 'embarque':
-            df = df[df['Nº EMBARQUE'].astype(
-                str).str.contains(value, case=False, na=False)]
-        else:
-            df = df[df['Air Waybill'].astype(
-                str).str.contains(value, case=False, na=False)]
+        df, busqueda = obtener_tablas()
+        df = df[coincidencias(busqueda, type, value)]
+        precio = columna_numerica(df['Precio Unitario'])
+        cantidad = columna_numerica(df['Cant'])
+        flete = columna_numerica(df['Flete'])
+        sub_total = precio * cantidad
+        df['Precio Unitario'] = precio
+        df['Cant'] = cantidad
+        df['Flete'] = flete
+        df['Sub Total'] = sub_total
+        df['Precio Total'] = sub_total + flete
+        df = df[COLUMNAS_DATOS]
         if df.empty:
             return {
                 "data": [],
                 "info": None,
                 "mensaje": f"No se encontraron resultados para {type}: {value}"
             }
-        df = df.replace({np.nan: None, np.inf: None, -np.inf: None})
+        df = reemplazar_nulos(df)
         if 'FECHA FACTURA' in df.columns:
             df['FECHA FACTURA'] = df['FECHA FACTURA'].astype(str)
         primera_fila = df.iloc[0]
@@ -265,10 +513,10 @@ def obtener_datos(type: Literal["embarque", "waybill"], value: str):
             "FORMA DE PAGO": primera_fila['FORMA DE PAGO'] if pd.notna(primera_fila['FORMA DE PAGO']) else "",
             "ESTADO": primera_fila['ESTADO'] if pd.notna(primera_fila['ESTADO']) else "",
         }
-        return {
+        return respuesta_json({
             "data": df.to_dict(orient='records'),
             "info": info
-        }
+        })
 
     except FileNotFoundError as e:
         print(str(e))
@@ -293,43 +541,10 @@ def exportar_datos(type: Literal["embarque", "waybill"], value: str):
         )
 
     try:
-        ruta_traduccion = os.path.join(download_dir, "Traduccion-Equipos.xlsx")
-        ruta_compras = os.path.join(download_dir, "002_Compras_OCI.xlsx")
         ruta_plantilla = os.path.join(download_dir, "Plantilla.xlsx")
 
-        a = pd.read_excel(ruta_traduccion, sheet_name='Datos', skiprows=4)
-        a = a.iloc[:, 1:]
-        a['ID'] = a['Modelo'].astype(str) + '-' + a['Codigo'].astype(str)
-        b = a[~a['ID'].duplicated()]
-        b = b[~b['Modelo'].duplicated()]
-        b['Codigo_Comercial'] = b['Modelo']
-        c = pd.read_excel(ruta_compras, skiprows=2)
-        df = pd.merge(c, b, how='left', on='Codigo_Comercial')
-        df['Sub Total'] = 0
-        df['Precio Total'] = 0
-        new_columns = {
-            'Cantidad': 'Cant',
-            'Num_OC': 'Nº O.COMPRA',
-            'Num_invoice': 'FACTURA',
-            'PaisOrigen': 'País De Origen',
-            'PCU1': 'Precio Unitario',
-            'Flete_US$': 'Flete',
-            'OperadorLogistico': 'TRANSPORTISTA',
-            'Fecha_Invoice': 'FECHA FACTURA',
-            'GrupoImportacion': 'Nº EMBARQUE',
-            'Num_DocTransporte': 'Air Waybill',
-            'RazonSocial_Proveedor': 'PROVEEDOR',
-            'Incoterm': 'INCOTERM',
-            'Forma_Pago': 'FORMA DE PAGO',
-            'Status_OCI': 'ESTADO'
-        }
-        df.rename(columns=new_columns, inplace=True)
-        if type == 'embarque':
-            df_filtered = df[df['Nº EMBARQUE'].astype(
-                str).str.contains(value, case=False, na=False)]
-        else:
-            df_filtered = df[df['Air Waybill'].astype(
-                str).str.contains(value, case=False, na=False)]
+        df, busqueda = obtener_tablas()
+        df_filtered = df[coincidencias(busqueda, type, value)]
 
         primera_fila = df_filtered.iloc[0]
         info = {
@@ -344,38 +559,41 @@ def exportar_datos(type: Literal["embarque", "waybill"], value: str):
             "ESTADO": primera_fila['ESTADO'] if pd.notna(primera_fila['ESTADO']) else "",
         }
 
-        df_filtered = df_filtered[[
-            'Item', 'Cant', 'Nº O.COMPRA', 'FACTURA', 'Codigo', 'Modelo', 'Descripcion',
-            'Material', 'Uso', 'País De Origen', 'Moneda', 'Precio Unitario', 'Sub Total',
-            'Flete', 'Precio Total'
-        ]]
+        # Sub Total y Precio Total quedan vacías hasta que se escriben sus fórmulas
+        df_filtered = df_filtered.reindex(columns=COLUMNAS_EXPORTAR)
 
         if df_filtered.empty:
             raise HTTPException(
                 status_code=404, detail="No se encontraron datos para exportar")
 
-        wb = load_workbook(ruta_plantilla)
+        # La plantilla tiene formatos, celdas combinadas, validaciones y la tabla
+        # Tabla24, que un libro write_only no puede conservar
+        wb = load_workbook(ruta_plantilla, keep_vba=False, keep_links=False)
         ws = wb.active
 
         table = ws.tables['Tabla24']
         min_col, min_row, max_col, max_row = range_boundaries(table.ref)
         start_row = max_row + 1
-        last_row = start_row - 1
+        last_row = start_row + len(df_filtered) - 1
+
+        # Las fórmulas se escriben en la misma pasada que los datos
+        filas = pd.Series(range(start_row, last_row + 1), index=df_filtered.index).astype(str)
+        df_filtered = df_filtered.assign(**{
+            'Sub Total': '=M' + filas + '*C' + filas,
+            'Precio Total': '=O' + filas + '+N' + filas,
+        })
 
+        # ws.cell conserva el formato de las celdas de la plantilla, a diferencia de ws.append;
+        # se asigna .value para que un None también limpie el contenido previo de la plantilla
         for row_idx, row in enumerate(
             dataframe_to_rows(df_filtered, index=False, header=False),
             start=start_row
         ):
-            for col, value in enumerate(row, start=min_col):
-                ws.cell(row=row_idx, column=col, value=value)
-            last_row = row_idx
+            for col, valor in enumerate(row, start=min_col):
+                ws.cell(row=row_idx, column=col).value = valor
 
         table.ref = f"{get_column_letter(min_col)}{min_row}:{get_column_letter(max_col)}{last_row}"
 
-        for row in range(start_row, last_row + 1):
-            ws[f'N{row}'] = f'=M{row}*C{row}'
-            ws[f'P{row}'] = f'=O{row}+N{row}'
-
         ws['D2'] = info['TRANSPORTISTA']
         fecha = primera_fila['FECHA FACTURA']
         fecha_obj = pd.to_datetime(fecha)
@@ -389,12 +607,14 @@ def exportar_datos(type: Literal["embarque", "waybill"], value: str):
         ws['K5'] = info['ESTADO']
         ws['K6'] = info['MARCA']
 
-        output_file = 'Validación_xd.xlsx'
-        wb.save(output_file)
-        return FileResponse(
-            path=output_file,
-            filename=output_file,
-            media_type='application/vnd.ms-excel.sheet.macroEnabled.12'
+        # Se genera en memoria para que exportaciones simultáneas no compartan archivo
+        buffer = io.BytesIO()
+        wb.save(buffer)
+        nombre_archivo = re.sub(r'[^A-Za-z0-9_-]', '_', f"Validacion_{value}")
+        return Response(
+            content=buffer.getvalue(),
+            media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            headers={'Content-Disposition': f'attachment; filename="{nombre_archivo}.xlsx"'}
         )
 
     except FileNotFoundError as e: